@@ -92,12 +92,17 @@ class BiasedCelebASplit:
 
         if target_attr != 'blonde':
             if split in ['train', 'train_valid']:
-                save_path = Path(f'clusters/celeba_rand_indices_{target_attr}.pkl')
-                if not save_path.exists():
-                    rand_indices = torch.randperm(len(self.indices))
-                    pickle.dump(rand_indices, open(save_path, 'wb'))
+                save_path = Path(f'clusters/celeba_rand_indices_{target_attr}.npy')
+                legacy_path = save_path.with_suffix('.pkl')
+                if save_path.exists():
+                    rand_indices = torch.from_numpy(np.load(save_path))
                 else:
-                    rand_indices = pickle.load(open(save_path, 'rb'))
+                    if legacy_path.exists(): # keep the split of runs cached with pickle
+                        with open(legacy_path, 'rb') as f:
+                            rand_indices = pickle.load(f)
+                    else:
+                        rand_indices = torch.randperm(len(self.indices))
+                    np.save(save_path, rand_indices.numpy())
 
                 num_total = len(rand_indices)
                 num_train = int(0.8 * num_total)
@@ -113,6 +118,10 @@ class BiasedCelebASplit:
             self.targets = self.attr[:, self.target_idx]
             self.biases = self.attr[:, self.bias_idx]
 
+        # plain int64 arrays so __getitem__ hands python ints to the default collate
+        self._targets_np = self.targets.long().numpy()
+        self._biases_np = self.biases.long().numpy()
+
         self.confusion_matrix_org, self.confusion_matrix, self.confusion_matrix_by = get_confusion_matrix(num_classes=2,
                                                                                                           targets=self.targets,
                                                                                                           biases=self.biases)
@@ -126,9 +135,10 @@ class BiasedCelebASplit:
     def build_blonde(self):
         biases = self.celeba.attr[:, self.bias_idx]
         targets = self.celeba.attr[:, self.target_idx]
-        selects = torch.arange(len(self.celeba))[(biases == 0) & (targets == 0)]
-        non_selects = torch.arange(len(self.celeba))[~((biases == 0) & (targets == 0))]
-        np.random.shuffle(selects)
+        mask = (biases == 0) & (targets == 0)
+        selects = mask.nonzero(as_tuple=False).squeeze(1)
+        non_selects = (~mask).nonzero(as_tuple=False).squeeze(1)
+        selects = selects[torch.randperm(selects.numel())]
         indices = torch.cat([selects[:2000], non_selects])
         return indices
 
@@ -140,7 +150,7 @@ class BiasedCelebASplit:
                                         self.filename_array[index])
             img = Image.open(img_filename)
             img = self.transform(img)
-        target, bias = self.targets[index], self.biases[index]
+        target, bias = int(self._targets_np[index]), int(self._biases_np[index])
         return img, target, bias, index
 
     def __len__(self):
@@ -148,11 +158,19 @@ class BiasedCelebASplit:
 
 
 def get_celeba(root, target_attr='blonde', split='train', simclr_aug=True,
-               img_size=224):
-    logging.info(f'get_celeba - split:{split}, aug: {simclr_aug}')
+               img_size=224, gpu_aug=False):
+    logging.info(f'get_celeba - split:{split}, aug: {simclr_aug}, gpu_aug: {gpu_aug}')
 
     if split == 'train':
-        if simclr_aug:
+        if simclr_aug and gpu_aug:
+            # Workers only decode and resize; SimCLR views are sampled on GPU.
+            # See GPUContrastiveLearningViewGenerator.
+            transform = T.Compose([
+                T.Resize(img_size),
+                T.CenterCrop(img_size),
+                T.PILToTensor(),
+            ])
+        elif simclr_aug:
             transform = T.Compose([
                 T.RandomResizedCrop(size=img_size, scale=(0.2, 1.)),
                 T.RandomHorizontalFlip(),
@@ -178,7 +196,7 @@ def get_celeba(root, target_attr='blonde', split='train', simclr_aug=True,
             T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])]
         )
 
-    if simclr_aug:
+    if simclr_aug and not gpu_aug:
         transform = ContrastiveLearningViewGenerator(transform)
 
     dataset = BiasedCelebASplit(
@@ -191,13 +209,14 @@ def get_celeba(root, target_attr='blonde', split='train', simclr_aug=True,
     return dataset
 
 def get_confusion_matrix(num_classes, targets, biases):
-    confusion_matrix_org = torch.zeros(num_classes, num_classes)
-    confusion_matrix_org_by = torch.zeros(num_classes, num_classes)
-    for t, p in zip(targets, biases):
-        confusion_matrix_org[p.long(), t.long()] += 1
-        confusion_matrix_org_by[t.long(), p.long()] += 1
-
-    confusion_matrix = confusion_matrix_org / confusion_matrix_org.sum(1).unsqueeze(1)
-    confusion_matrix_by = confusion_matrix_org_by / confusion_matrix_org_by.sum(1).unsqueeze(1)
+    targets, biases = targets.long(), biases.long()
+    num_cells = num_classes * num_classes
+    confusion_matrix_org = torch.bincount(biases * num_classes + targets,
+                                          minlength=num_cells).view(num_classes, num_classes).float()
+    confusion_matrix_org_by = torch.bincount(targets * num_classes + biases,
+                                             minlength=num_cells).view(num_classes, num_classes).float()
+
+    confusion_matrix = confusion_matrix_org / confusion_matrix_org.sum(1, keepdim=True)
+    confusion_matrix_by = confusion_matrix_org_by / confusion_matrix_org_by.sum(1, keepdim=True)
     # confusion_matrix = confusion_matrix_org / confusion_matrix_org.sum()
     return confusion_matrix_org, confusion_matrix, confusion_matrix_by
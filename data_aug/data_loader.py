@@ -17,6 +17,13 @@ from sklearn.model_selection import ShuffleSplit
 from torch.utils.data import Subset
 
 
+def worker_kwargs(args):
+    # Keep workers alive across epochs and prefetch deeper; both options require num_workers > 0
+    if args.num_workers == 0:
+        return {}
+    return dict(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+
+
 def get_original_loader(args, return_dataset=False, sampling_weight=None, simclr_aug=True,
                         finetune=False, inverted_sampling=False, shuffle=True, return_num_data=False, finetune_ratio=0.):
     dataset_name = args.data
@@ -25,7 +32,7 @@ def get_original_loader(args, return_dataset=False, sampling_weight=None, simclr
                                simclr_aug=simclr_aug, img_size=64, bias_rate=0.9,)
     elif dataset_name == 'celebA':
         dataset = get_celeba(args.data_dir, target_attr=args.target_attr, split='train',
-                             simclr_aug=simclr_aug, img_size=224)
+                             simclr_aug=simclr_aug, img_size=224, gpu_aug=args.gpu_aug)
     elif dataset_name == 'bffhq':
         dataset = get_bFFHQ(args.data_dir, split='train', simclr_aug=simclr_aug)
     elif dataset_name == 'stl10mnist':
@@ -75,6 +82,7 @@ def get_original_loader(args, return_dataset=False, sampling_weight=None, simclr
                                    num_workers=args.num_workers,
                                    sampler=sampler,
                                    pin_memory=True,
+                                   **worker_kwargs(args),
                                    drop_last=simclr_aug)
         else:
             return data.DataLoader(dataset=dataset,
@@ -82,6 +90,7 @@ def get_original_loader(args, return_dataset=False, sampling_weight=None, simclr
                                    shuffle=shuffle,
                                    num_workers=args.num_workers,
                                    pin_memory=True,
+                                   **worker_kwargs(args),
                                    drop_last=simclr_aug)
 
 def get_val_loader(args, split='valid'):
@@ -119,7 +128,8 @@ def get_val_loader(args, split='valid'):
                            batch_size=args.batch_size,
                            shuffle=False,
                            num_workers=args.num_workers,
-                           pin_memory=True)
+                           pin_memory=True,
+                           **worker_kwargs(args))
 
 
 class InputFetcher:
@@ -1,14 +1,43 @@
 import numpy as np
+import torch
 
 np.random.seed(0)
 
 
 class ContrastiveLearningViewGenerator(object):
-    """Take two random crops of one image as the query and key."""
+    """Take two random crops of one image as the query and key. The views are
+    stacked into one (n_views, C, H, W) tensor so a batch collates, pins and
+    transfers as a single (B, n_views, C, H, W) tensor."""
 
     def __init__(self, base_transform, n_views=2):
         self.base_transform = base_transform
         self.n_views = n_views
 
     def __call__(self, x):
-        return [self.base_transform(x) for i in range(self.n_views)]
+        return torch.stack([self.base_transform(x) for i in range(self.n_views)], dim=0)
+
+
+class GPUContrastiveLearningViewGenerator(object):
+    """Batched SimCLR augmentation on GPU. Takes a uint8 (B, C, H, W) batch and
+    returns the n_views augmented views concatenated along the batch dimension."""
+
+    def __init__(self, img_size, n_views=2):
+        try:
+            import kornia.augmentation as K
+        except ImportError as e:
+            raise ImportError("--gpu_aug requires kornia: pip install kornia") from e
+
+        self.n_views = n_views
+        self.base_transform = K.AugmentationSequential(
+            K.RandomResizedCrop((img_size, img_size), scale=(0.2, 1.)),
+            K.RandomHorizontalFlip(),
+            K.ColorJitter(0.4, 0.4, 0.4, 0.1, p=0.8),
+            K.RandomGrayscale(p=0.2),
+            K.Normalize(mean=torch.tensor([0.485, 0.456, 0.406]),
+                        std=torch.tensor([0.229, 0.224, 0.225])),
+            data_keys=["input"],
+        )
+
+    def __call__(self, x):
+        x = x.float() / 255.
+        return torch.cat([self.base_transform(x) for i in range(self.n_views)], dim=0)
@@ -46,7 +46,14 @@ class FC(nn.Module):
 def build_model(args):
     n_classes = num_classes[args.data]
 
-    encoder = arch[args.arch](n_classes, args.simclr_dim, pretrain=True if args.data != 'imagenet' else False)
+    # ERM only uses the penultimate features; contrastive runs need the head of args.mode_CL
+    contrastive = args.mode != 'ERM'
+    heads = dict(use_simclr=contrastive and args.mode_CL == 'SimCLR',
+                 use_simsiam=contrastive and args.mode_CL == 'SimSiam',
+                 use_vicreg=contrastive and args.mode_CL == 'vicReg')
+
+    encoder = arch[args.arch](n_classes, args.simclr_dim, pretrain=True if args.data != 'imagenet' else False,
+                              **heads)
     classifier= FC(last_dim[args.arch], n_classes)
 
     nets = Munch(encoder=encoder,
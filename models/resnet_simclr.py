@@ -24,55 +24,62 @@ class SimCLRResNet(ResNet):
                  width_per_group: int = 64,
                  replace_stride_with_dilation: Optional[List[bool]] = None,
                  norm_layer: Optional[Callable[..., nn.Module]] = None,
+                 use_simclr: bool = False,
+                 use_simsiam: bool = False,
+                 use_vicreg: bool = False,
             ) -> None:
         super(SimCLRResNet, self).__init__(block, layers, num_classes, zero_init_residual,
                                         groups, width_per_group, replace_stride_with_dilation,
                                         norm_layer)
         last_dim = 512 * block.expansion
 
-        self.simclr_layer = nn.Sequential(
-            nn.Linear(last_dim, last_dim),
-            nn.ReLU(),
-            nn.Linear(last_dim, simclr_dim),
-        )
+        # Projection heads are only built when requested; the vicReg head alone is ~150M params
+        if use_simclr:
+            self.simclr_layer = nn.Sequential(
+                nn.Linear(last_dim, last_dim),
+                nn.ReLU(),
+                nn.Linear(last_dim, simclr_dim),
+            )
 
 
 
         ###########
         # Simsiam
         ###########
-        prj_dim = last_dim * 8
-        pred_dim = last_dim * 4
-        self.simsiam_prj_layer = nn.Sequential(
-            nn.Linear(last_dim, last_dim, bias=False),
-            # nn.BatchNorm1d(last_dim),
-            # nn.ReLU(inplace=True),
-            # nn.Linear(last_dim, last_dim, bias=False),
-            nn.BatchNorm1d(last_dim),
-            nn.ReLU(inplace=True),
-            nn.Linear(last_dim, prj_dim, bias=False),
-            nn.BatchNorm1d(prj_dim, affine=False)
-        )
-
-        self.simsiam_pred_layer = nn.Sequential(
-            nn.Linear(prj_dim, pred_dim, bias=False),
-            nn.BatchNorm1d(pred_dim),
-            nn.ReLU(inplace=True),
-            nn.Linear(pred_dim, prj_dim)
-        )
+        if use_simsiam:
+            prj_dim = last_dim * 8
+            pred_dim = last_dim * 4
+            self.simsiam_prj_layer = nn.Sequential(
+                nn.Linear(last_dim, last_dim, bias=False),
+                # nn.BatchNorm1d(last_dim),
+                # nn.ReLU(inplace=True),
+                # nn.Linear(last_dim, last_dim, bias=False),
+                nn.BatchNorm1d(last_dim),
+                nn.ReLU(inplace=True),
+                nn.Linear(last_dim, prj_dim, bias=False),
+                nn.BatchNorm1d(prj_dim, affine=False)
+            )
+
+            self.simsiam_pred_layer = nn.Sequential(
+                nn.Linear(prj_dim, pred_dim, bias=False),
+                nn.BatchNorm1d(pred_dim),
+                nn.ReLU(inplace=True),
+                nn.Linear(pred_dim, prj_dim)
+            )
 
         ###########
         # vicReg
         ###########
-        dim = 8192
-        mlp_spec = [last_dim, dim, dim, dim]
-        temp_layers = []
-        for i in range(mlp_spec.__len__()-2):
-            temp_layers.append(nn.Linear(mlp_spec[i], mlp_spec[i+1]))
-            temp_layers.append(nn.BatchNorm1d(mlp_spec[i + 1]))
-            temp_layers.append(nn.ReLU(True))
-        temp_layers.append(nn.Linear(mlp_spec[-2], mlp_spec[-1], bias=False))
-        self.vicReg_layer = nn.Sequential(*temp_layers)
+        if use_vicreg:
+            dim = 8192
+            mlp_spec = [last_dim, dim, dim, dim]
+            temp_layers = []
+            for i in range(mlp_spec.__len__()-2):
+                temp_layers.append(nn.Linear(mlp_spec[i], mlp_spec[i+1]))
+                temp_layers.append(nn.BatchNorm1d(mlp_spec[i + 1]))
+                temp_layers.append(nn.ReLU(True))
+            temp_layers.append(nn.Linear(mlp_spec[-2], mlp_spec[-1], bias=False))
+            self.vicReg_layer = nn.Sequential(*temp_layers)
 
 
 
@@ -116,8 +123,8 @@ class SimCLRResNet(ResNet):
         return aux
 
 
-def ResNet18(num_classes, simclr_dim, pretrain=True):
-    net = SimCLRResNet(BasicBlock, [2, 2, 2, 2], simclr_dim)
+def ResNet18(num_classes, simclr_dim, pretrain=True, **heads):
+    net = SimCLRResNet(BasicBlock, [2, 2, 2, 2], simclr_dim, **heads)
     if pretrain:
         url = URL_DICT['resnet18']
         checkpoint = load_url(url)
@@ -126,8 +133,8 @@ def ResNet18(num_classes, simclr_dim, pretrain=True):
     net = modify_last_layer(net, num_classes)
     return net
 
-def ResNet50(num_classes, simclr_dim, pretrain=True):
-    net = SimCLRResNet(Bottleneck, [3, 4, 6, 3], simclr_dim)
+def ResNet50(num_classes, simclr_dim, pretrain=True, **heads):
+    net = SimCLRResNet(Bottleneck, [3, 4, 6, 3], simclr_dim, **heads)
     if pretrain:
         url = URL_DICT['resnet50']
         checkpoint = load_url(url)
@@ -136,11 +143,11 @@ def ResNet50(num_classes, simclr_dim, pretrain=True):
     net = modify_last_layer(net, num_classes)
     return net
 
-def Build_ResNet(base_model, num_classes, simclr_dim):
+def Build_ResNet(base_model, num_classes, simclr_dim, **heads):
     if base_model == 'resnet18':
-        return ResNet18(num_classes, simclr_dim)
+        return ResNet18(num_classes, simclr_dim, **heads)
     elif base_model == 'resnet50':
-        return ResNet50(num_classes, simclr_dim)
+        return ResNet50(num_classes, simclr_dim, **heads)
     else:
         return NotImplementedError
 
@@ -4,7 +4,8 @@ import torch.nn as nn
 
 
 class ConvNet(nn.Module):
-    def __init__(self, simclr_dim=128, num_classes=2, pretrain=False):
+    def __init__(self, simclr_dim=128, num_classes=2, pretrain=False,
+                 use_simclr=False, use_simsiam=False, use_vicreg=False):
         super().__init__()
 
         last_dim = 256
@@ -25,47 +26,50 @@ class ConvNet(nn.Module):
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         self.fc = nn.Linear(last_dim, num_classes)
 
-        self.simclr_layer = nn.Sequential(
-            nn.Linear(last_dim, last_dim),
-            nn.ReLU(),
-            nn.Linear(last_dim, simclr_dim),
-        )
+        if use_simclr:
+            self.simclr_layer = nn.Sequential(
+                nn.Linear(last_dim, last_dim),
+                nn.ReLU(),
+                nn.Linear(last_dim, simclr_dim),
+            )
 
         ###########
         # Simsiam
         ###########
-        prj_dim = last_dim * 8
-        pred_dim = last_dim * 4
-        self.simsiam_prj_layer = nn.Sequential(
-            nn.Linear(last_dim, last_dim, bias=False),
-            # nn.BatchNorm1d(last_dim),
-            # nn.ReLU(inplace=True),
-            # nn.Linear(last_dim, last_dim, bias=False),
-            nn.BatchNorm1d(last_dim),
-            nn.ReLU(inplace=True),
-            nn.Linear(last_dim, prj_dim, bias=False),
-            nn.BatchNorm1d(prj_dim, affine=False)
-        )
-
-        self.simsiam_pred_layer = nn.Sequential(
-            nn.Linear(prj_dim, pred_dim, bias=False),
-            nn.BatchNorm1d(pred_dim),
-            nn.ReLU(inplace=True),
-            nn.Linear(pred_dim, prj_dim)
-        )
+        if use_simsiam:
+            prj_dim = last_dim * 8
+            pred_dim = last_dim * 4
+            self.simsiam_prj_layer = nn.Sequential(
+                nn.Linear(last_dim, last_dim, bias=False),
+                # nn.BatchNorm1d(last_dim),
+                # nn.ReLU(inplace=True),
+                # nn.Linear(last_dim, last_dim, bias=False),
+                nn.BatchNorm1d(last_dim),
+                nn.ReLU(inplace=True),
+                nn.Linear(last_dim, prj_dim, bias=False),
+                nn.BatchNorm1d(prj_dim, affine=False)
+            )
+
+            self.simsiam_pred_layer = nn.Sequential(
+                nn.Linear(prj_dim, pred_dim, bias=False),
+                nn.BatchNorm1d(pred_dim),
+                nn.ReLU(inplace=True),
+                nn.Linear(pred_dim, prj_dim)
+            )
 
         ###########
         # vicReg
         ###########
-        dim = 4096
-        mlp_spec = [last_dim, dim, dim, dim]
-        temp_layers = []
-        for i in range(mlp_spec.__len__()-2):
-            temp_layers.append(nn.Linear(mlp_spec[i], mlp_spec[i+1]))
-            temp_layers.append(nn.BatchNorm1d(mlp_spec[i + 1]))
-            temp_layers.append(nn.ReLU(True))
-        temp_layers.append(nn.Linear(mlp_spec[-2], mlp_spec[-1], bias=False))
-        self.vicReg_layer = nn.Sequential(*temp_layers)
+        if use_vicreg:
+            dim = 4096
+            mlp_spec = [last_dim, dim, dim, dim]
+            temp_layers = []
+            for i in range(mlp_spec.__len__()-2):
+                temp_layers.append(nn.Linear(mlp_spec[i], mlp_spec[i+1]))
+                temp_layers.append(nn.BatchNorm1d(mlp_spec[i + 1]))
+                temp_layers.append(nn.ReLU(True))
+            temp_layers.append(nn.Linear(mlp_spec[-2], mlp_spec[-1], bias=False))
+            self.vicReg_layer = nn.Sequential(*temp_layers)
 
     def penultimate(self, x):
         x = self.encoder(x)
@@ -98,6 +102,6 @@ class ConvNet(nn.Module):
         return aux
 
 
-def SimpleConvNet(num_classes, simclr_dim, pretrain=False):
-    net = ConvNet(simclr_dim, num_classes)
+def SimpleConvNet(num_classes, simclr_dim, pretrain=False, **heads):
+    net = ConvNet(simclr_dim, num_classes, **heads)
     return net
@@ -15,6 +15,11 @@ def main():
 
     cudnn.deterministic = True
     cudnn.benchmark = True
+    # TF32 tensor-core matmuls/convs on Ampere+ (rank-reg covariance, projection heads)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    cudnn.allow_tf32 = True
+    if hasattr(torch, 'set_float32_matmul_precision'): # torch >= 1.12
+        torch.set_float32_matmul_precision('high')
     torch.manual_seed(args.seed)
 
     if args.mode == 'oversample':
@@ -94,6 +99,8 @@ if __name__ == "__main__":
                         help='mini-batch size (default: 256), this is the total '
                             'batch size of all GPUs on the current node when '
                             'using Data Parallel or Distributed Data Parallel')
+    parser.add_argument('--grad_accum_steps', default=1, type=int,
+                        help='micro-batches accumulated per encoder update during SimCLR pretraining')
     parser.add_argument('--wd', '--weight-decay', default=1e-4, type=float,
                         metavar='W', help='weight decay (default: 1e-4)',
                         dest='weight_decay')
@@ -115,9 +122,19 @@ if __name__ == "__main__":
                         help='seed for initializing training. ')
     parser.add_argument('--fp16-precision', action='store_true',
                         help='Whether or not to use 16-bit precision GPU training.')
+    parser.add_argument('--compile', action='store_true',
+                        help='Wrap encoder/classifier with torch.compile (PyTorch 2.0+)')
+    parser.add_argument('--bf16', action='store_true',
+                        help='Use bfloat16 autocast (no loss scaling) for SimCLR pretraining. Ampere+ only.')
+    parser.add_argument('--gpu_aug', action='store_true',
+                        help='Sample SimCLR views on GPU with kornia instead of in workers (celebA only)')
     parser.add_argument('--num_workers', default=12, type=int, metavar='N',
                         help='number of data loading workers (default: 32)')
+    parser.add_argument('--prefetch_factor', default=4, type=int,
+                        help='batches prefetched per data loading worker')
 
+    parser.add_argument('--debug_save_first_batch', action='store_true',
+                        help='Save the first augmented SimCLR batch to test.png before pretraining')
     parser.add_argument('--log-every-n-steps', default=100, type=int,
                         help='Log every n steps')
     parser.add_argument('--eval_every', default=500, type=int,
@@ -16,7 +16,7 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from utils import accuracy, CheckpointIO, MultiDimAverageMeter
 
-from models.build_models import build_model, num_classes, last_dim
+from models.build_models import build_model, num_classes
 from data_aug.data_loader import get_original_loader, get_val_loader, InputFetcher
 
 
@@ -27,6 +27,7 @@ class ERMSolver(nn.Module):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.num_classes = num_classes[args.data]
         self.attr_dims = [self.num_classes, self.num_classes]
+        self._eye_tsr = torch.eye(self.attr_dims[0], dtype=torch.long)
 
         self.nets = build_model(args)
         # below setattrs are to make networks be children of Solver, e.g., for self.to(self.device)
@@ -60,20 +61,23 @@ class ERMSolver(nn.Module):
 
         if self.args.lambda_upweight != 1 and self.args.oversample_pth is not None:
             pth = self.args.oversample_pth
-            wrong_label = torch.load(pth)
-            upweight = torch.ones_like(wrong_label)
+            wrong_label = torch.load(pth).bool()
+            upweight = torch.ones(wrong_label.shape, device=wrong_label.device)
             if self.args.finetune:
                 indices = np.load(ospj(self.args.checkpoint_dir, f'subset_indices_{self.args.finetune_ratio}.npy'))
-                for ind, _ in enumerate(upweight):
-                    if ind not in indices:
-                        upweight[ind] = 0
+                mask = torch.zeros_like(upweight, dtype=torch.bool)
+                mask[torch.as_tensor(indices, dtype=torch.long)] = True
+                upweight[~mask] = 0
 
             print(f'Number of wrong/total samples: {wrong_label.sum()}/{upweight.sum()}. Finetuning: {self.args.finetune}')
 
-            upweight[wrong_label == 1] = self.args.lambda_upweight
+            upweight.masked_fill_(wrong_label, self.args.lambda_upweight)
             upweight_loader = get_original_loader(self.args, sampling_weight=upweight, simclr_aug=False)
             self.loaders = Munch(train=upweight_loader)
 
+        # every train loader above wraps the full (non-finetune) train split
+        self._train_dataset_len = len(self.loaders.train.dataset)
+
         if args.finetune:
             self.loaders.train_finetune = get_original_loader(args, simclr_aug=False, finetune=True, finetune_ratio=args.finetune_ratio)
 
@@ -90,16 +94,23 @@ class ERMSolver(nn.Module):
 
         self.scheduler = Munch()
         milestones = [int(args.ERM_epochs/3), int(args.ERM_epochs/3)]
-        self.scheduler.classifier = torch.optim.lr_scheduler.MultiStepLR(
-            self.optims[net], milestones=milestones, gamma=args.lr_decay_gamma
-        )
+        for net in self.nets.keys():
+            self.scheduler[net] = torch.optim.lr_scheduler.MultiStepLR(
+                self.optims[net], milestones=milestones, gamma=args.lr_decay_gamma
+            )
 
         self.writer = SummaryWriter(args.log_dir)
         self.criterion = torch.nn.CrossEntropyLoss()
         self.gce = GeneralizedCELoss()
-        self.normalize = nn.BatchNorm1d(last_dim[args.arch], affine=False)
 
         self.to(self.device)
+        # NHWC for tensor-core conv kernels
+        self.nets.encoder.to(memory_format=torch.channels_last)
+
+        if args.compile:
+            # ckptios keep the uncompiled modules, so checkpoints have no '_orig_mod.' prefix
+            self.nets.encoder = torch.compile(self.nets.encoder, mode='reduce-overhead')
+            self.nets.classifier = torch.compile(self.nets.classifier, mode='reduce-overhead')
 
     def _reset_grad(self):
         def _recursive_reset(optims_dict):
@@ -127,11 +138,11 @@ class ERMSolver(nn.Module):
         total_correct, total_num = 0, 0
 
         for images, labels, bias, _ in tqdm(fetcher):
-            label = labels.to(self.device)
-            images = images.to(self.device)
-            bias = bias.to(self.device)
+            attr = torch.stack([labels, bias], dim=1) # meter indexes on CPU
+            label = labels.to(self.device, non_blocking=True)
+            images = images.to(self.device, non_blocking=True, memory_format=torch.channels_last)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(enabled=self.args.fp16_precision):
                 aux = self.nets.encoder(images, simclr=False, penultimate=True)
                 features_penul = aux['penultimate']
                 logit = self.nets.classifier(features_penul)
@@ -141,8 +152,7 @@ class ERMSolver(nn.Module):
                 total_correct += correct.sum()
                 total_num += correct.shape[0]
 
-            attr = torch.cat((labels.view(-1,1).to(self.device), bias.view(-1,1).to(self.device)), dim=1)
-            attrwise_acc_meter.add(correct.cpu(), attr.cpu())
+            attrwise_acc_meter.add(correct.cpu(), attr)
 
         print(attrwise_acc_meter.cum.view(self.attr_dims[0], -1))
         print(attrwise_acc_meter.cnt.view(self.attr_dims[0], -1))
@@ -155,9 +165,8 @@ class ERMSolver(nn.Module):
         return total_acc, accs
 
     def report_validation(self, valid_attrwise_acc, valid_acc, step=0):
-        eye_tsr = torch.eye(self.attr_dims[0]).long()
-        valid_acc_align = valid_attrwise_acc[eye_tsr == 1].mean().item()
-        valid_acc_conflict = valid_attrwise_acc[eye_tsr == 0].mean().item()
+        valid_acc_align = valid_attrwise_acc[self._eye_tsr == 1].mean().item()
+        valid_acc_conflict = valid_attrwise_acc[self._eye_tsr == 0].mean().item()
 
         all_acc = dict()
         for acc, key in zip([valid_acc, valid_acc_align, valid_acc_conflict],
@@ -176,15 +185,14 @@ class ERMSolver(nn.Module):
 
         total = 0
         f_correct = 0
-        num_correct = [np.zeros([num_classes, num_clusters]) for _ in range(num_cluster_repeat)]
-        num_instance = [np.zeros([num_classes, num_clusters]) for _ in range(num_cluster_repeat)]
+        num_correct = torch.zeros(num_cluster_repeat, num_classes, num_clusters, device=self.device)
+        num_instance = torch.zeros(num_cluster_repeat, num_classes, num_clusters, device=self.device)
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast(enabled=self.args.fp16_precision):
             for images, labels, bias_labels, index in val_loader:
 
-                images, labels = images.to(self.device), labels.to(self.device)
-                for bias_label in bias_labels:
-                    bias_label.to(self.device)
+                images = images.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+                labels = labels.to(self.device, non_blocking=True)
 
                 aux = self.nets.encoder(images, simclr=False, penultimate=True)
                 features_penul = aux['penultimate']
@@ -204,8 +212,9 @@ class ERMSolver(nn.Module):
         self.nets.classifier.train()
 
         if key == 'unbiased':
-            result = {'num_correct': np.array(num_correct),
-                      'num_instance': np.array(num_instance)}
+            num_correct, num_instance = num_correct.cpu().numpy(), num_instance.cpu().numpy()
+            result = {'num_correct': num_correct,
+                      'num_instance': num_instance}
             np.save(ospj(self.args.log_dir, 'unbiased_acc_array.npy'), result)
             for k in range(num_cluster_repeat):
                 x, y = [], []
@@ -224,17 +233,14 @@ class ERMSolver(nn.Module):
     def imagenet_unbiased_accuracy(self, outputs, labels, cluster_labels,
                                    num_correct, num_instance,
                                    num_cluster_repeat=3):
+        num_clusters = num_correct.size(-1)
+        correct = (outputs.argmax(1) == labels).float()
+        ones = torch.ones_like(correct)
         for j in range(num_cluster_repeat):
-            for i in range(outputs.size(0)):
-                output = outputs[i]
-                label = labels[i]
-                cluster_label = cluster_labels[j][i]
-
-                _, pred = output.topk(1, 0, largest=True, sorted=True)
-                correct = pred.eq(label).view(-1).float()
-
-                num_correct[j][label][cluster_label] += correct.item()
-                num_instance[j][label][cluster_label] += 1
+            # flattened (label, cluster_label) cell of each sample
+            cell = labels * num_clusters + cluster_labels[j].to(labels.device).long()
+            num_correct[j].view(-1).scatter_add_(0, cell, correct)
+            num_instance[j].view(-1).scatter_add_(0, cell, ones)
 
         return num_correct, num_instance
 
@@ -243,12 +249,6 @@ class ERMSolver(nn.Module):
         n_correct = (predicted == labels).sum().item()
         return n_correct
 
-    def off_diagonal(self, x):
-        # return a flattened view of the off-diagonal elements of a square matrix
-        n, m = x.shape
-        assert n == m
-        return x.flatten()[:-1].view(n - 1, n + 1)[:, 1:].flatten()
-
     def train(self):
         scaler = GradScaler(enabled=self.args.fp16_precision)
         imagenet_stats = {'biased': [], 'unbiased': [], 'ImageNetA': []}
@@ -264,21 +264,30 @@ class ERMSolver(nn.Module):
         i = 0
         for epoch_counter in range(self.args.ERM_epochs):
             for images, labels, _, _ in tqdm(loader):
-                images = images.to(self.args.device)
-                labels = labels.to(self.args.device)
+                images = images.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+                labels = labels.to(self.device, non_blocking=True)
 
                 #for ind, img in enumerate(images):
                 #    torchvision.utils.save_image(img, f'recon/{i}iter_{labels[0]}_{labels[1]}.png', normalize=True)
 
-                aux = self.nets.encoder(images, simclr=False, penultimate=True)
-                features_penul = aux['penultimate']
-                c = self.normalize(features_penul).T @ self.normalize(features_penul)
-                c.div_(self.args.batch_size)
-                loss_offdiag = self.off_diagonal(c).pow_(2).sum() / features_penul.size(1) ** 2
-
-                logits = self.nets.classifier(features_penul)
-                loss_ce = self.criterion(logits, labels)
-                loss = loss_ce - self.args.lambda_offdiag * loss_offdiag
+                with autocast(enabled=self.args.fp16_precision):
+                    aux = self.nets.encoder(images, simclr=False, penultimate=True)
+                    features_penul = aux['penultimate']
+                    if self.args.lambda_offdiag != 0.:
+                        # batch standardization (BatchNorm1d w/o affine), minus the running-stat updates;
+                        # kept out of autocast so the covariance matmul stays fp32
+                        with autocast(enabled=False):
+                            f = features_penul.float()
+                            z = (f - f.mean(0)) * torch.rsqrt(f.var(0, unbiased=False) + 1e-5)
+                            c = z.T @ z
+                            c.div_(self.args.batch_size)
+                            loss_offdiag = (c.pow(2).sum() - c.diagonal().pow(2).sum()) / features_penul.size(1) ** 2
+                    else:
+                        loss_offdiag = torch.zeros((), device=features_penul.device)
+
+                    logits = self.nets.classifier(features_penul)
+                    loss_ce = self.criterion(logits, labels)
+                    loss = loss_ce - self.args.lambda_offdiag * loss_offdiag
                 #loss = self.gce(logits, labels).mean()
 
                 self.optims.classifier.zero_grad()
@@ -296,13 +305,13 @@ class ERMSolver(nn.Module):
                     self.writer.add_scalar('loss/ce', loss_ce, global_step=n_iter)
                     self.writer.add_scalar('loss/rank_reg', loss_offdiag, global_step=n_iter)
                     self.writer.add_scalar('acc/top1', top1[0], global_step=n_iter)
-                    self.writer.add_scalar('learning_rate', self.scheduler.classifier.get_lr()[0], global_step=n_iter)
+                    self.writer.add_scalar('learning_rate', self.optims.classifier.param_groups[0]['lr'], global_step=n_iter)
 
                 n_iter += 1
 
                 #self.scheduler.classifier.step()
 
-            msg = f"Epoch: {epoch_counter}\tLR: {self.scheduler.classifier.get_lr()[0]}\tLoss: {loss}\tTop1 accuracy: {top1[0]}"
+            msg = f"Epoch: {epoch_counter}\tLR: {self.optims.classifier.param_groups[0]['lr']}\tLoss: {loss}\tTop1 accuracy: {top1[0]}"
             logging.info(msg)
             print(msg)
 
@@ -322,7 +331,8 @@ class ERMSolver(nn.Module):
                 print(msg)
 
             if self.args.oversample_pth is None:
-                self.save_score_idx(loader=get_original_loader(self.args, simclr_aug=False), epoch=epoch_counter)
+                # same loader as get_original_loader(self.args, simclr_aug=False), reused across epochs
+                self.save_score_idx(loader=self.loaders.train, epoch=epoch_counter)
 
 
         logging.info("Training has finished.")
@@ -334,8 +344,7 @@ class ERMSolver(nn.Module):
     def save_score_idx(self, loader, epoch=None):
         self.nets.encoder.eval()
         self.nets.classifier.eval()
-        dataset = get_original_loader(self.args, return_dataset=True, simclr_aug=False)
-        num_data = len(dataset)
+        num_data = self._train_dataset_len
 
         iterator = enumerate(loader)
         score_idx = torch.zeros(num_data).to(self.device)
@@ -344,18 +353,18 @@ class ERMSolver(nn.Module):
         total_num = 0
 
         for _, (images, labels, bias_labels, idx) in iterator:
-            idx = idx.to(self.device)
-            labels = labels.to(self.device)
-            bias_labels = bias_labels.to(self.device)
-            images= images.to(self.device)
+            idx = idx.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            bias_labels = bias_labels.to(self.device, non_blocking=True)
+            images = images.to(self.device, non_blocking=True, memory_format=torch.channels_last)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(enabled=self.args.fp16_precision):
                 aux = self.nets.encoder(images, freeze=True, penultimate=True)
                 features_penul = aux['penultimate']
                 logits = self.nets.classifier(features_penul)
 
                 # bias score
-                bias_prob = nn.Softmax()(logits)[torch.arange(logits.size(0)), labels]
+                bias_prob = F.log_softmax(logits, dim=1).gather(1, labels[:, None]).squeeze(1).exp()
                 bias_score = 1 - bias_prob
 
                 # wrong
@@ -365,10 +374,9 @@ class ERMSolver(nn.Module):
                 # true label
                 debiased = (labels != bias_labels).float()
 
-                for i, v in enumerate(idx):
-                    score_idx[v] = bias_score[i]
-                    debias_idx[v] = debiased[i]
-                    wrong_idx[v] = wrong[i]
+                score_idx.index_copy_(0, idx, bias_score.float())
+                debias_idx.index_copy_(0, idx, debiased)
+                wrong_idx.index_copy_(0, idx, wrong.float())
 
             total_num += labels.shape[0]
 
@@ -431,15 +439,11 @@ class GeneralizedCELoss(nn.Module):
         self.q = q
 
     def forward(self, logits, targets):
-        p = F.softmax(logits, dim=1)
-        if np.isnan(p.mean().item()):
-            raise NameError('GCE_p')
-        Yg = torch.gather(p, 1, torch.unsqueeze(targets, 1))
+        # single log_softmax: -log_Yg is the per-sample cross entropy
+        log_Yg = F.log_softmax(logits, dim=1).gather(1, targets[:, None]).squeeze(1)
         # modify gradient of cross entropy
-        loss_weight = (Yg.squeeze().detach()**self.q)*self.q
-        if np.isnan(Yg.mean().item()):
-            raise NameError('GCE_Yg')
+        loss_weight = (log_Yg.detach().exp()**self.q)*self.q
 
-        loss = F.cross_entropy(logits, targets, reduction='none') * loss_weight
+        loss = -log_Yg * loss_weight
 
         return loss
@@ -308,8 +308,8 @@ class LinearEvalSolver(SimCLRSolver):
                 logits = self.nets.classifier(features_penul)
                 loss = self.criterion(logits, labels)
 
-            self.optims.classifier.zero_grad()
-            if finetune: self.optims.encoder.zero_grad()
+            self.optims.classifier.zero_grad(set_to_none=True)
+            if finetune: self.optims.encoder.zero_grad(set_to_none=True)
 
             scaler.scale(loss).backward()
 
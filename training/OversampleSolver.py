@@ -3,6 +3,7 @@ from os.path import join as ospj
 import os
 import logging
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from data_aug.data_loader import get_original_loader, get_val_loader, InputFetcher
@@ -17,24 +18,22 @@ class OversampleSolver(LinearEvalSolver):
 
     def make_pseudo_label(self):
         score_file_name = lambda ld: ospj(self.args.score_file_template(ld), 'score_idx.pth')
-        score_file = score_file_name(0.) # It must exists
-        score = torch.load(score_file)
+        score_files = [score_file_name(0.)] # It must exists
+        score_files += [score_file_name(ld) for ld in self.args.lambda_list if ld != 0.]
 
-        for ld in self.args.lambda_list:
-            if ld == 0.:
-                continue
-            else:
-                new_score = torch.load(score_file_name(ld))
-                score += new_score
-        score /= len(self.args.lambda_list)
-        pseudo_label = (score > self.args.cutoff).float()
+        # file reads overlap across threads; torch.load releases the GIL during I/O
+        load = lambda f: torch.load(f, map_location='cpu')
+        with ThreadPoolExecutor() as executor:
+            scores = list(executor.map(load, score_files))
+        score = torch.stack(scores).sum(dim=0) / len(self.args.lambda_list)
+        pseudo_label = score > self.args.cutoff # saved as a bool mask, 1 byte per sample
 
         wrong_idx_path = ospj(self.args.checkpoint_dir, 'wrong_index_final.pth')
         torch.save(pseudo_label, wrong_idx_path)
 
         if self.args.data != 'imagenet':
             debias_idx_path = ospj(self.args.checkpoint_dir, 'debias_idx.pth')
-            debias_label = torch.load(debias_idx_path)
+            debias_label = torch.load(debias_idx_path, map_location='cpu')
 
             self.pseudo_label_precision_recall(pseudo_label, debias_label)
 
@@ -76,17 +75,17 @@ class OversampleSolver(LinearEvalSolver):
         except:
             raise ValueError('Either pretrained SimCLR or pseudo bias label does not exist')
 
-        wrong_label = torch.load(pth)
-        upweight = torch.ones_like(wrong_label)
+        wrong_label = torch.load(pth).bool()
+        upweight = torch.ones(wrong_label.shape, device=wrong_label.device)
         if self.args.finetune:
             indices = np.load(ospj(self.args.checkpoint_dir, f'subset_indices_{self.args.finetune_ratio}.npy'))
-            for ind, _ in enumerate(upweight):
-                if ind not in indices:
-                    upweight[ind] = 0
+            mask = torch.zeros_like(upweight, dtype=torch.bool)
+            mask[torch.as_tensor(indices, dtype=torch.long)] = True
+            upweight[~mask] = 0
 
         print(f'Number of wrong/total samples: {wrong_label.sum()}/{upweight.sum()}. Finetuning: {self.args.finetune}')
 
-        upweight[wrong_label == 1] = self.args.lambda_upweight
+        upweight.masked_fill_(wrong_label, self.args.lambda_upweight)
         upweight_loader = get_original_loader(self.args, sampling_weight=upweight, simclr_aug=False)
         upweight_fetcher = InputFetcher(upweight_loader)
 
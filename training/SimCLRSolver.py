@@ -5,19 +5,35 @@ import datetime
 from munch import Munch
 import logging
 import sys
+import inspect
 
 import torchvision
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
-from torch.cuda.amp import GradScaler, autocast
+from torch.amp import autocast
+try:
+    from torch.amp import GradScaler
+except ImportError: # PyTorch < 2.3
+    from torch.cuda.amp import GradScaler
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from utils import accuracy, CheckpointIO, MultiDimAverageMeter
 
 from models.build_models import build_model, num_classes, last_dim
 from data_aug.data_loader import get_original_loader, get_val_loader, InputFetcher
+from data_aug.view_generator import GPUContrastiveLearningViewGenerator
+
+
+def multi_tensor_kwargs(optim_cls, device):
+    # fused kernels on CUDA where this torch build offers them (SGD: 2.3+), else foreach, else default
+    params = inspect.signature(optim_cls.__init__).parameters
+    if device.type == 'cuda' and 'fused' in params:
+        return {'fused': True}
+    if 'foreach' in params:
+        return {'foreach': True}
+    return {}
 
 
 class SimCLRSolver(nn.Module):
@@ -32,6 +48,8 @@ class SimCLRSolver(nn.Module):
         # below setattrs are to make networks be children of Solver, e.g., for self.to(self.device)
         for name, module in self.nets.items():
             setattr(self, name, module)
+        # fused optimizers need their params on the device at construction time
+        self.to(self.device)
 
         self.optims = Munch() # Used in pretraining
         for net in self.nets.keys():
@@ -44,14 +62,16 @@ class SimCLRSolver(nn.Module):
                 self.optims[net] = torch.optim.Adam(
                     self.nets[net].parameters(),
                     lr,
-                    weight_decay=args.weight_decay
+                    weight_decay=args.weight_decay,
+                    **multi_tensor_kwargs(torch.optim.Adam, self.device)
                 )
             elif args.optimizer == 'SGD':
                 self.optims[net] = torch.optim.SGD(
                     self.nets[net].parameters(),
                     lr,
                     momentum=0.9,
-                    weight_decay=args.weight_decay
+                    weight_decay=args.weight_decay,
+                    **multi_tensor_kwargs(torch.optim.SGD, self.device)
                 )
 
         self.ckptios = [
@@ -86,52 +106,65 @@ class SimCLRSolver(nn.Module):
         self.writer = SummaryWriter(args.log_dir)
         self.criterion = torch.nn.CrossEntropyLoss()
         self.normalize = nn.BatchNorm1d(last_dim[args.arch], affine=False)
+        # InfoNCE indices/targets for a full 2-view batch, moved to the device by self.to() below;
+        # feature batches of any other size fall back to _nce_cache
+        num_nce = args.n_views * args.batch_size
+        nce_idx = torch.arange(num_nce)
+        self.register_buffer('nce_idx', nce_idx, persistent=False)
+        self.register_buffer('nce_pos_idx', (nce_idx + num_nce // 2) % num_nce, persistent=False)
+        self.register_buffer('nce_targets', torch.zeros(num_nce, dtype=torch.long), persistent=False)
+        self._nce_cache = {}
+        self.gpu_aug = None
+        if args.gpu_aug and args.data == 'celebA':
+            self.gpu_aug = GPUContrastiveLearningViewGenerator(img_size=224, n_views=args.n_views)
 
         self.to(self.device)
+        self.nets.encoder.to(memory_format=torch.channels_last)
+
+        if args.compile:
+            self.nets.encoder = torch.compile(self.nets.encoder, mode='max-autotune')
+            self.simclr_objective = torch.compile(self.simclr_objective)
 
     def _reset_grad(self):
-        def _recursive_reset(optims_dict):
-            for _, optim in optims_dict.items():
-                if isinstance(optim, dict):
-                    _recursive_reset(optim)
-                else:
-                    optim.zero_grad()
-        return _recursive_reset(self.optims)
-
-    def _save_checkpoint(self, step, token):
+        for optim in self.optims.values():
+            optim.zero_grad(set_to_none=True)
+
+    def _save_checkpoint(self, step, token, blocking=True):
         for ckptio in self.ckptios:
-            ckptio.save(step, token)
+            ckptio.save(step, token, blocking)
 
     def _load_checkpoint(self, step, token, which=None, return_fname=False):
         for ckptio in self.ckptios:
             ckptio.load(step, token, which, return_fname)
 
-    def info_nce_loss(self, features):
-        labels = torch.cat([torch.arange(self.args.batch_size) for i in range(self.args.n_views)], dim=0)
-        labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-        labels = labels.to(self.args.device)
+    def _nce_index(self, num, device):
+        # row/positive-column indices and CE targets only depend on the batch size; build them once per size
+        if num == self.nce_idx.numel():
+            return self.nce_idx, self.nce_pos_idx, self.nce_targets
+        if num not in self._nce_cache:
+            idx = torch.arange(num, device=device)
+            pos_idx = (idx + num // 2) % num
+            labels = torch.zeros(num, dtype=torch.long, device=device)
+            self._nce_cache[num] = (idx, pos_idx, labels)
+        return self._nce_cache[num]
 
+    def info_nce_loss(self, features):
+        # rows i and i + n are the two views of the same image
+        assert self.args.n_views == 2
+        n = features.shape[0] // 2
         features = F.normalize(features, dim=1)
 
         similarity_matrix = torch.matmul(features, features.T)
-        # assert similarity_matrix.shape == (
-        #     self.args.n_views * self.args.batch_size, self.args.n_views * self.args.batch_size)
-        # assert similarity_matrix.shape == labels.shape
-
-        # discard the main diagonal from both: labels and similarities matrix
-        mask = torch.eye(labels.shape[0], dtype=torch.bool).to(self.args.device)
-        labels = labels[~mask].view(labels.shape[0], -1)
-        similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
-        # assert similarity_matrix.shape == labels.shape
 
-        # select and combine multiple positives
-        positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
+        idx, pos_idx, labels = self._nce_index(2 * n, features.device)
+        positives = similarity_matrix[idx, pos_idx]
 
-        # select only the negatives the negatives
-        negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
+        # drop self-similarity and the positive from the negatives by masking them to -inf,
+        # instead of boolean-gathering a (2n, 2n-2) copy; they vanish from the softmax either way
+        similarity_matrix.fill_diagonal_(float('-inf'))
+        similarity_matrix[idx, pos_idx] = float('-inf')
 
-        logits = torch.cat([positives, negatives], dim=1)
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).to(self.args.device)
+        logits = torch.cat([positives.unsqueeze(1), similarity_matrix], dim=1)
 
         logits = logits / self.args.temperature
         return logits, labels
@@ -141,13 +174,12 @@ class SimCLRSolver(nn.Module):
     ############
 
     def simsiam_loss(self, f_prj, f_pred):
-        z_1 = f_prj[:f_prj.shape[0] // 2, :].detach()
-        z_2 = f_prj[f_prj.shape[0] // 2:, :].detach()
+        b = f_prj.shape[0] // 2
+        # cosine similarity as a dot product of unit vectors, normalized once for both pairs
+        z = F.normalize(f_prj.detach(), dim=1)
+        p = F.normalize(f_pred, dim=1)
 
-        p_1 = f_pred[:f_pred.shape[0] // 2, :]
-        p_2 = f_pred[f_pred.shape[0] // 2:, :]
-
-        loss = nn.CosineSimilarity(dim=1)(p_1, z_2).mean() + nn.CosineSimilarity(dim=1)(p_2, z_1).mean()
+        loss = (p[:b] * z[b:]).sum(dim=1).mean() + (p[b:] * z[:b]).sum(dim=1).mean()
         loss *= 0.5
         loss *= self.args.lambda_simsiam
 
@@ -171,8 +203,8 @@ class SimCLRSolver(nn.Module):
 
         cov_1 = (z_1.T @ z_1) / (b - 1)
         cov_2 = (z_2.T @ z_2) / (b - 1)
-        loss_cov = self.off_diagonal(cov_1).pow_(2).sum().div(dim) \
-                   + self.off_diagonal(cov_2).pow_(2).sum().div(dim)
+        loss_cov = self.off_diagonal_sq_sum(cov_1).div(dim) \
+                   + self.off_diagonal_sq_sum(cov_2).div(dim)
 
 
         loss = loss_pos * self.args.lambda_vicReg_pos \
@@ -182,75 +214,104 @@ class SimCLRSolver(nn.Module):
         return loss
 
 
-    def off_diagonal(self, x):
-        # return a flattened view of the off-diagonal elements of a square matrix
+    def off_diagonal_sq_sum(self, x):
+        # sum of squared off-diagonal elements of a square matrix, ||x||_F^2 - ||diag(x)||^2,
+        # without copying the off-diagonal elements out
         n, m = x.shape
         assert n == m
-        return x.flatten()[:-1].view(n - 1, n + 1)[:, 1:].flatten()
+        return x.pow(2).sum() - x.diagonal().pow(2).sum()
+
+    def _prepare_views(self, images):
+        # loader batch -> view-major (n_views * B, C, H, W) channels_last tensor on the device
+        if self.gpu_aug is not None:
+            images = self.gpu_aug(images.to(self.device, non_blocking=True))
+            return images.contiguous(memory_format=torch.channels_last)
+
+        # stacked (B, V, C, H, W) views; the reshape is the only copy and lands directly in NHWC
+        b, v, c, h, w = images.shape
+        images = images.to(self.device, non_blocking=True)
+        return images.permute(1, 0, 3, 4, 2).reshape(v * b, h, w, c).permute(0, 3, 1, 2)
+
+    def rank_loss(self, features_penul):
+        # Covariance regularization
+        z = self.normalize(features_penul)
+        c = z.T @ z
+        c.div_(self.args.batch_size)
+        return self.off_diagonal_sq_sum(c) / features_penul.size(1) ** 2
+
+    def simclr_objective(self, features_simclr, features_penul):
+        # Everything after the encoder in a SimCLR step; compiled as one region when args.compile
+        logits, labels = self.info_nce_loss(features_simclr)
+        loss_nce = self.criterion(logits, labels)
+        loss_offdiag = self.rank_loss(features_penul)
+        loss = loss_nce - self.args.lambda_offdiag * loss_offdiag
+        return loss, logits, labels, loss_nce, loss_offdiag
 
     def contrastive_train(self):
-        scaler = GradScaler(enabled=self.args.fp16_precision)
+        # bf16 has fp32's exponent range, so it needs no loss scaling
+        amp_dtype = torch.bfloat16 if self.args.bf16 else torch.float16
+        amp_enabled = self.args.fp16_precision or self.args.bf16
+        scaler = GradScaler(enabled=self.args.fp16_precision and not self.args.bf16)
 
         n_iter = 0
         logging.info(f"Start SimCLR training for {self.args.simclr_epochs} epochs.")
-        i = 0
-
-        for epoch_counter in range(self.args.simclr_epochs):
-            for images, _, _, _ in tqdm(self.loaders.train_simclr):
-                images = torch.cat(images, dim=0)
 
-                images = images.to(self.args.device)
-                if i == 0:
-                    torchvision.utils.save_image(images, 'test.png', normalize=True)
-                    i+=1
+        if self.args.debug_save_first_batch:
+            images, _, _, _ = next(iter(self.loaders.train_simclr))
+            torchvision.utils.save_image(self._prepare_views(images), 'test.png', normalize=True)
 
+        num_batches = len(self.loaders.train_simclr)
+        for epoch_counter in range(self.args.simclr_epochs):
+            for i, (images, _, _, _) in enumerate(tqdm(self.loaders.train_simclr)):
+                images = self._prepare_views(images)
 
-                with autocast(enabled=self.args.fp16_precision):
+                with autocast(device_type=self.device.type, dtype=amp_dtype, enabled=amp_enabled):
                     if self.args.mode_CL == 'SimCLR':
                         aux = self.nets.encoder(images, simclr=True, penultimate=True)
-                        features_simclr = aux['simclr']
-                        logits, labels = self.info_nce_loss(features_simclr)
-                        loss_nce = self.criterion(logits, labels)
-
-
-                    elif self.args.mode_CL == 'SimSiam':
-                        aux = self.nets.encoder(images, simsiam=True, penultimate=True)
-                        features_prj = aux['simsiam_prj']
-                        features_pred = aux['simsiam_pred']
-                        loss_nce = self.simsiam_loss(features_prj, features_pred)
-                        logits, labels = self.info_nce_loss(features_prj.detach())
-
-                    elif self.args.mode_CL == 'vicReg':
-                        aux = self.nets.encoder(images, vicReg=True, penultimate=True)
-                        features_vicReg = aux['vicReg']
-                        loss_nce = self.vicReg_loss(features_vicReg)
-                        logits, labels = self.info_nce_loss(features_vicReg.detach())
+                        loss, logits, labels, loss_nce, loss_offdiag = self.simclr_objective(
+                            aux['simclr'], aux['penultimate'])
 
-                    # ---------------------------------------------------------
-                    # Covariance regularization
-                    features_penul = aux['penultimate']
-                    c = self.normalize(features_penul).T @ self.normalize(features_penul)
-                    c.div_(self.args.batch_size)
-                    loss_offdiag = self.off_diagonal(c).pow_(2).sum() / features_penul.size(1) ** 2
-                    # ---------------------------------------------------------
+                    else:
+                        if self.args.mode_CL == 'SimSiam':
+                            aux = self.nets.encoder(images, simsiam=True, penultimate=True)
+                            features_prj = aux['simsiam_prj']
+                            features_pred = aux['simsiam_pred']
+                            loss_nce = self.simsiam_loss(features_prj, features_pred)
+                            logits, labels = self.info_nce_loss(features_prj.detach())
 
-                    loss = loss_nce - self.args.lambda_offdiag * loss_offdiag
+                        elif self.args.mode_CL == 'vicReg':
+                            aux = self.nets.encoder(images, vicReg=True, penultimate=True)
+                            features_vicReg = aux['vicReg']
+                            loss_nce = self.vicReg_loss(features_vicReg)
+                            logits, labels = self.info_nce_loss(features_vicReg.detach())
 
+                        loss_offdiag = self.rank_loss(aux['penultimate'])
+                        loss = loss_nce - self.args.lambda_offdiag * loss_offdiag
 
-                self.optims.encoder.zero_grad()
 
-                scaler.scale(loss).backward()
+                # effective batch = batch_size * grad_accum_steps; InfoNCE negatives stay per micro-batch
+                scaler.scale(loss / self.args.grad_accum_steps).backward()
 
-                scaler.step(self.optims.encoder)
-                scaler.update()
+                # accumulation windows are per epoch; a trailing partial window is stepped here too,
+                # so no gradients leak across the scheduler step and the epoch checkpoint
+                if (i + 1) % self.args.grad_accum_steps == 0 or i + 1 == num_batches:
+                    scaler.step(self.optims.encoder)
+                    scaler.update()
+                    self.optims.encoder.zero_grad(set_to_none=True)
 
                 if n_iter % self.args.log_every_n_steps == 0:
-                    top1, top5 = accuracy(logits, labels, topk=(1, 5))
-                    self.writer.add_scalar('loss_nce', loss_nce, global_step=n_iter)
-                    self.writer.add_scalar('loss_offdiag', loss_offdiag, global_step=n_iter)
-                    self.writer.add_scalar('acc/top1', top1[0], global_step=n_iter)
-                    self.writer.add_scalar('acc/top5', top5[0], global_step=n_iter)
-                    self.writer.add_scalar('learning_rate', self.scheduler.encoder.get_lr()[0], global_step=n_iter)
+                    # top-1 is a single argmax; the top-k sort for top-5 only runs at 10x the log cadence
+                    top1 = (logits.detach().argmax(dim=1) == labels).float().mean() * 100.
+                    keys = ['loss_nce', 'loss_offdiag', 'acc/top1']
+                    values = [loss_nce.detach().float(), loss_offdiag.detach().float(), top1]
+                    if n_iter % (10 * self.args.log_every_n_steps) == 0:
+                        top5, = accuracy(logits, labels, topk=(5, ))
+                        keys.append('acc/top5')
+                        values.append(top5[0])
+                    # one device->host copy for all logged scalars instead of a sync per add_scalar
+                    for key, value in zip(keys, torch.stack(values).tolist()):
+                        self.writer.add_scalar(key, value, global_step=n_iter)
+                    self.writer.add_scalar('learning_rate', self.optims.encoder.param_groups[0]['lr'], global_step=n_iter)
 
                 n_iter += 1
 
@@ -263,12 +324,13 @@ class SimCLRSolver(nn.Module):
                     self.scheduler.encoder.step()
 
             lr = self.scheduler.encoder.get_lr()[0]
-            msg = f"Epoch: {epoch_counter}\tLoss: {loss}\tLR: {lr}\tTop1 accuracy: {top1[0]}"
+            msg = f"Epoch: {epoch_counter}\tLoss: {loss}\tLR: {lr}\tTop1 accuracy: {top1}"
             logging.info(msg)
             print(msg)
 
             if (epoch_counter + 1) % self.args.save_every == 0:
-                self._save_checkpoint(step=epoch_counter+1, token='biased_simclr')
+                # written in the background while the next epoch runs
+                self._save_checkpoint(step=epoch_counter+1, token='biased_simclr', blocking=False)
 
         logging.info("Training has finished.")
         # save model checkpoints
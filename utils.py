@@ -1,6 +1,7 @@
 import os
 from os.path import join as ospj
 import shutil
+import threading
 
 import torch
 import yaml
@@ -108,6 +109,8 @@ class CheckpointIO(object):
         os.makedirs(os.path.dirname(fname_template), exist_ok=True)
         self.fname_template = fname_template
         self.module_dict = kwargs
+        self._save_thread = None
+        self._save_error = None
 
     def register(self, **kwargs):
         self.module_dict.update(kwargs)
@@ -119,15 +122,42 @@ class CheckpointIO(object):
     def load_label(self):
         return torch.load(self.fname_template)
 
-    def save(self, step, token):
+    def save(self, step, token, blocking=True):
+        """With blocking=False, the state is snapshotted to CPU here and written by a background thread."""
         fname = self.fname_template.format(step, token)
         print('Saving checkpoint into %s...' % fname)
         outdict = {}
         for name, module in self.module_dict.items():
-            outdict[name] = module.state_dict()
-        torch.save(outdict, fname)
+            state_dict = module.state_dict()
+            if not blocking:
+                state_dict = {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+            outdict[name] = state_dict
+
+        self.wait()
+        if blocking:
+            torch.save(outdict, fname)
+        else:
+            self._save_thread = threading.Thread(target=self._save_worker, args=(outdict, fname))
+            self._save_thread.start()
+
+    def _save_worker(self, outdict, fname):
+        # errors in the thread are kept for wait() to re-raise on the training thread
+        try:
+            torch.save(outdict, fname)
+        except BaseException as e:
+            self._save_error = e
+
+    def wait(self):
+        # block until a pending non-blocking save has hit the disk
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+        if self._save_error is not None:
+            error, self._save_error = self._save_error, None
+            raise error
 
     def load(self, step, token, which=None, return_fname=False):
+        self.wait()
         fname = self.fname_template.format(step, token)
         if not os.path.exists(fname): print(f'WARNING: {fname} does not exist!')
         if return_fname: return fname